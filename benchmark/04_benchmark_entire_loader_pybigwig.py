@@ -107,9 +107,8 @@ class PyBigWigDataset:
     def __next__(self):
         if self._n < self.batches_per_epoch:
             self._n += 1
-            positions, sequences = self.genome.get_batch()
-            chromosomes, center = zip(*positions)
-            start = np.array(center) - (self.center_bin_to_predict // 2)
+            chromosomes, center, sequences = self.genome.get_batch()
+            start = center - (self.center_bin_to_predict // 2)
             end = start + self.center_bin_to_predict
             target = self.get_target_batch(chromosomes, start, end)
             return sequences, target
@@ -1,4 +1,5 @@
 import logging
+import threading
 from functools import cached_property
 from pathlib import Path
 from typing import Any
@@ -15,8 +16,10 @@ import pandas as pd
 from bigwig_loader.bigwig import BigWig
 from bigwig_loader.gpu_decompressor import Decoder
 from bigwig_loader.intervals_to_values_gpu import intervals_to_values
+from bigwig_loader.memory_bank import CuFileMemoryBank
 from bigwig_loader.memory_bank import MemoryBank
 from bigwig_loader.memory_bank import create_memory_bank
+from bigwig_loader.memory_bank import cufile_compat_mode
 from bigwig_loader.merge_intervals import merge_interval_dataframe
 from bigwig_loader.path import interpret_path
 from bigwig_loader.path import map_path_to_value
@@ -57,6 +60,12 @@ class BigWigCollection:
         use_cufile: bool = True,
     ):
         self._use_cufile = use_cufile
+        if use_cufile and cufile_compat_mode():
+            logging.warning(
+                "kvikio is running in compatibility mode: data is read through host "
+                "memory instead of directly from storage to GPU memory using GPUDirect "
+                "Storage. See the README for the needed driver and file system setup."
+            )
         self.bigwig_paths = sorted(
             interpret_path(bigwig_path, file_extensions=file_extensions, crawl=crawl)
         )[:first_n_files]
@@ -84,6 +93,10 @@ class BigWigCollection:
         )
         self.pinned_memory_size = pinned_memory_size
         self._out: cp.ndarray = cp.zeros((len(self), 1, 1), dtype=cp.float32)
+        self._previous_batch_done: Optional[cp.cuda.Event] = None
+        # get_batch reuses the memory bank and decoder buffers and can be
+        # called from the prefetch threads of several datasets.
+        self._lock = threading.Lock()
 
         self.run_indexing()
 
@@ -100,16 +113,20 @@ class BigWigCollection:
         """
         Remove all gpu arrays from the previously used device and recreate when necessary on
         current device. This is useful when training is done on multiple gpus and the arrays
-        need to be recreated on the new gpu.
+        need to be recreated on the new gpu. When the collection is shared by several
+        datasets, this moves it to the current device for all of them.
         """
-
-        self._out = cp.zeros((len(self), 1, 1), dtype=cp.float32)
-        if "decoder" in self.__dict__:
-            del self.__dict__["decoder"]
-        if "memory_bank" in self.__dict__:
-            del self.__dict__["memory_bank"]
-        if "scaling_factors_cupy" in self.__dict__:
-            del self.__dict__["scaling_factors_cupy"]
+        with self._lock:
+            self._out = cp.zeros((len(self), 1, 1), dtype=cp.float32)
+            self._previous_batch_done = None
+            if "decoder" in self.__dict__:
+                del self.__dict__["decoder"]
+            if "memory_bank" in self.__dict__:
+                if isinstance(self.memory_bank, CuFileMemoryBank):
+                    self.memory_bank.deregister_memory()
+                del self.__dict__["memory_bank"]
+            if "scaling_factors_cupy" in self.__dict__:
+                del self.__dict__["scaling_factors_cupy"]
 
     @cached_property
     def decoder(self) -> Decoder:
@@ -154,6 +171,22 @@ class BigWigCollection:
         window_size: int = 1,
         out: Optional[cp.ndarray] = None,
     ) -> cp.ndarray:
+        with self._lock:
+            return self._get_batch(chromosomes, start, end, window_size, out)
+
+    def _get_batch(
+        self,
+        chromosomes: Union[Sequence[str], npt.NDArray[np.generic]],
+        start: Union[Sequence[int], npt.NDArray[np.int64]],
+        end: Union[Sequence[int], npt.NDArray[np.int64]],
+        window_size: int,
+        out: Optional[cp.ndarray],
+    ) -> cp.ndarray:
+        if self._previous_batch_done is not None:
+            # The memory bank and decoder buffers are reused. When the collection
+            # is shared by several datasets, the previous batch might have been
+            # loaded on another stream and still be using them.
+            self._previous_batch_done.synchronize()
         self.memory_bank.reset()
 
         if (end[0] - start[0]) % window_size:
@@ -198,6 +231,11 @@ class BigWigCollection:
             f"Cupy default memory pool:{ cp.get_default_memory_pool().used_bytes() / 1024} kB"
         )
 
+        # the same queries are used for every bigwig file, copy them
+        # to the gpu only once.
+        query_starts = cp.asarray(abs_start, dtype=cp.uint32)
+        query_ends = cp.asarray(abs_end, dtype=cp.uint32)
+
         chunk_row_numbers = cp.pad(cp.cumsum(n_rows_for_chunks), (1, 0))
         i = 0
         for n_chunks, partial_out in zip(n_chunks_per_bigwig, out):
@@ -210,14 +248,15 @@ class BigWigCollection:
                 track_starts=start[row_number_start:row_number_end],
                 track_ends=end[row_number_start:row_number_end],
                 track_values=value[row_number_start:row_number_end],
-                query_starts=cp.asarray(abs_start, dtype=cp.uint32),
-                query_ends=cp.asarray(abs_end, dtype=cp.uint32),
+                query_starts=query_starts,
+                query_ends=query_ends,
                 window_size=window_size,
                 out=partial_out,
             )
             i = bigwig_end
         batch = cp.transpose(out, (1, 0, 2))
         batch *= self.scaling_factors_cupy
+        self._previous_batch_done = cp.cuda.get_current_stream().record()
         return batch
 
     def make_positions_global(
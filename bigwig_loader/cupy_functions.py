@@ -1,13 +1,50 @@
+from typing import Optional
+
 import cupy as cp
 
+_moving_average_kernel = cp.ElementwiseKernel(
+    "raw T array, int32 bins, int32 window_size",
+    "U out",
+    """
+    const int position = i % bins;
+    const ptrdiff_t row_start = i - position;
+    const int first = max(position - window_size / 2, 0);
+    const int last = min(position + (window_size - 1) / 2, bins - 1);
+    float summation = 0.0f;
+    for (int j = first; j <= last; j++) {
+        summation += array[row_start + j];
+    }
+    out = (U)(summation / window_size);
+    """,
+    "moving_average",
+)
+
 
-def moving_average(array: cp.ndarray, window_size: int) -> cp.ndarray:
+def moving_average(
+    array: cp.ndarray, window_size: int, out: Optional[cp.ndarray] = None
+) -> cp.ndarray:
+    """
+    Moving average over the last axis of the array, the same as convolving every
+    row with a box kernel of size window_size (mode="same", zero padded). This is
+    done in a single kernel, writing directly to out if it is given.
+    Args:
+        array: array to smooth.
+        window_size: size of the moving average window.
+        out: Optional, preallocated array of the same shape as array. Can be of
+            another (floating point) dtype, to convert while smoothing.
+    Returns:
+        smoothed array of the same shape as array.
+    """
+    if out is not None and out.shape != array.shape:
+        raise ValueError(
+            f"out should have the same shape as array {array.shape}, not {out.shape}"
+        )
     if window_size == 1:
-        return array
-    kernel = cp.ones(window_size) / window_size
-    # pad_size = window_size // 2
-    # arr_padded = cp.pad(array, ((0, 0), (0, 0), (pad_size, pad_size)), mode="constant")
-    result = cp.apply_along_axis(
-        lambda m: cp.convolve(m, kernel, mode="same"), axis=-1, arr=array
-    )
-    return result
+        if out is None:
+            return array
+        cp.copyto(out, array)
+        return out
+    array = cp.ascontiguousarray(array)
+    if out is None:
+        out = cp.empty_like(array)
+    return _moving_average_kernel(array, array.shape[-1], window_size, out)
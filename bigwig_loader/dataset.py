@@ -1,4 +1,8 @@
 import math
+import threading
+import weakref
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 from typing import Callable
@@ -10,6 +14,7 @@ from typing import Union
 
 import cupy as cp
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
 
 from bigwig_loader.collection import BigWigCollection
@@ -17,6 +22,65 @@ from bigwig_loader.cupy_functions import moving_average
 from bigwig_loader.genome import Genome
 from bigwig_loader.position_sampler import PositionSampler
 
+# BigWigCollections created from paths, shared by all datasets that use the
+# same files, so files are opened and registered with cuFile only once.
+_collection_cache: "weakref.WeakValueDictionary[Any, BigWigCollection]" = (
+    weakref.WeakValueDictionary()
+)
+_collection_cache_lock = threading.Lock()
+
+
+def _shared_collection(
+    bigwig_path: Union[str, Sequence[str], Path, Sequence[Path]],
+    file_extensions: Sequence[str],
+    crawl: bool,
+    scale: Optional[dict[Union[str | Path], Any]],
+    first_n_files: Optional[int],
+    use_cufile: bool,
+) -> BigWigCollection:
+    """
+    Get the BigWigCollection for these arguments from the cache, or create it
+    when no dataset is using it at the moment.
+    """
+    if isinstance(bigwig_path, (str, Path)):
+        paths: tuple[str, ...] = (str(bigwig_path),)
+    else:
+        paths = tuple(sorted(str(path) for path in bigwig_path))
+    key = (
+        paths,
+        tuple(file_extensions),
+        crawl,
+        tuple(sorted((str(k), v) for k, v in scale.items())) if scale else None,
+        first_n_files,
+        use_cufile,
+    )
+    with _collection_cache_lock:
+        collection = _collection_cache.get(key)
+        if collection is None:
+            collection = BigWigCollection(
+                bigwig_path,
+                file_extensions=file_extensions,
+                crawl=crawl,
+                scale=scale,
+                first_n_files=first_n_files,
+                use_cufile=use_cufile,
+            )
+            _collection_cache[key] = collection
+        return collection
+
+
+def _default_batches_per_epoch(
+    regions_of_interest: pd.DataFrame, sequence_length: int, batch_size: int
+) -> int:
+    """
+    Number of batches needed to (on average) cover all bases in the
+    regions of interest once.
+    """
+    lengths = (
+        regions_of_interest["end"].to_numpy() - regions_of_interest["start"].to_numpy()
+    )
+    return int(lengths.sum()) // sequence_length // batch_size
+
 
 class BigWigDataset:
     """
@@ -49,6 +113,7 @@ class BigWigDataset:
         maximum_unknown_bases_fraction: maximum number of bases in an input sequence that
             is unknown.
         sequence_encoder: encoder to apply to the sequence. Default: bigwig_loader.util.onehot_sequences
+            When the encoder returns a numeric numpy array, it is copied to the GPU as a CuPy array.
         file_extensions: load files with these extensions (default .bw and .bigWig)
         crawl: whether to search in sub-directories for BigWig files
         scale: Optional, dictionary with scaling factors for each BigWig file.
@@ -62,7 +127,9 @@ class BigWigDataset:
             of positions when the buffer runs out, but repeats the same samples. Can be used to
             check whether network can overfit.
         use_cufile: whether to use kvikio cuFile to directly load data from file to GPU memory.
-
+        target_dtype: floating point dtype of the target, cp.float16 halves its memory
+            footprint. The values are computed in float32 and converted at the end.
+            Default: cp.float32.
     """
 
     def __init__(
@@ -88,19 +155,19 @@ class BigWigDataset:
         position_sampler_buffer_size: int = 100000,
         repeat_same_positions: bool = False,
         use_cufile: bool = True,
+        target_dtype: npt.DTypeLike = cp.float32,
     ):
         self.batch_size = batch_size
         super_batch_size = super_batch_size or batch_size
         if super_batch_size < batch_size:
-            raise AttributeError(
-                f"super_batch_size {batch_size} can not be smaller than batch_size {batch_size}"
+            raise ValueError(
+                f"super_batch_size ({super_batch_size}) must be >= batch_size ({batch_size})"
             )
-        self.batches_per_epoch = (
-            batches_per_epoch
-            or (regions_of_interest["end"] - regions_of_interest["start"]).sum()
-            // sequence_length
-            // batch_size
-        )
+        if batches_per_epoch is None:
+            batches_per_epoch = _default_batches_per_epoch(
+                regions_of_interest, sequence_length, batch_size
+            )
+        self.batches_per_epoch = batches_per_epoch
 
         super_batches_per_epoch = math.ceil(
             batch_size * self.batches_per_epoch / super_batch_size
@@ -125,22 +192,43 @@ class BigWigDataset:
             position_sampler_buffer_size=position_sampler_buffer_size,
             repeat_same_positions=repeat_same_positions,
             use_cufile=use_cufile,
+            target_dtype=target_dtype,
+            n_out_buffers=2,
         )
+        self._prefetcher = _PrefetchSuperBatch(self._super_dataset)
         self._super_batch_sequences: cp.ndarray = None
         self._super_batch_targets: cp.ndarray = None
         self._n = 0
         self._offset = 0
+        self._reset_on_next = True
 
     def reset_gpu(self) -> None:
+        """
+        Recreate the GPU state on the current device. The BigWigCollection can
+        be shared with other datasets, which are moved to this device as well.
+        """
+        self._prefetcher.reset_gpu()
         self._super_dataset.reset_gpu()
 
-    def __iter__(self) -> Iterator[tuple[Any, cp.ndarray]]:
+    def _reset(self) -> None:
+        """
+        Start a new epoch: reset the counters and start prefetching the
+        first super batch.
+        """
         self._n = 0
         self._offset = 0
-        iter(self._super_dataset)
+        self._super_batch_sequences = None
+        self._super_batch_targets = None
+        self._prefetcher.start()
+        self._reset_on_next = False
+
+    def __iter__(self) -> Iterator[tuple[Any, cp.ndarray]]:
+        self._reset_on_next = True
         return self
 
     def __next__(self) -> tuple[Any, cp.ndarray]:
+        if self._reset_on_next:
+            self._reset()
         if self._n < self.batches_per_epoch:
             self._n += 1
             if (
@@ -149,7 +237,7 @@ class BigWigDataset:
                 or self._offset + self.batch_size > self._super_dataset.batch_size
             ):
                 self._super_batch_sequences, self._super_batch_targets = next(
-                    self._super_dataset
+                    self._prefetcher
                 )
                 self._offset = 0
 
@@ -162,9 +250,112 @@ class BigWigDataset:
             self._offset += self.batch_size
             return sequences, target
 
+        self._reset_on_next = True
         raise StopIteration
 
 
+class _PrefetchSuperBatch:
+    """
+    Two slot prefetch queue around a BigWigSuperDataset. As soon as a super
+    batch is handed out, the next one is loaded in a background thread on a
+    separate non-blocking CUDA stream, so that the whole load (reading the
+    genome, reading and decoding the BigWig files) runs while the current
+    super batch is being consumed. The super dataset should rotate over (at
+    least) two output buffers, so the batch being loaded does not overwrite
+    the one being consumed.
+    Args:
+        super_dataset: the BigWigSuperDataset to prefetch super batches from.
+    """
+
+    def __init__(self, super_dataset: "BigWigSuperDataset"):
+        self._super_dataset = super_dataset
+        self._stream: Optional[cp.cuda.Stream] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Optional[
+            Future[tuple[Optional[tuple[Any, cp.ndarray]], cp.cuda.Event]]
+        ] = None
+        self._started = False
+
+    @property
+    def stream(self) -> cp.cuda.Stream:
+        if self._stream is None:
+            self._stream = cp.cuda.Stream(non_blocking=True)
+        return self._stream
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="bigwig_loader_prefetch"
+            )
+        return self._executor
+
+    def _wait_for_pending(self) -> None:
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def reset_gpu(self) -> None:
+        """
+        Drop the prefetch stream and any pending super batch, they belong to
+        the previously used device.
+        """
+        self._wait_for_pending()
+        self._stream = None
+        self._started = False
+
+    def start(self) -> None:
+        """
+        Start a new epoch of the super dataset and start loading the
+        first super batch.
+        """
+        self._wait_for_pending()
+        iter(self._super_dataset)
+        self._started = True
+        self._schedule()
+
+    def _schedule(self) -> None:
+        # The buffer the next super batch is written into might still be
+        # read by work queued on the consumer's stream.
+        consumer_done = cp.cuda.get_current_stream().record()
+        self._pending = self.executor.submit(
+            self._load, cp.cuda.Device(), self.stream, consumer_done
+        )
+
+    def _load(
+        self,
+        device: cp.cuda.Device,
+        stream: cp.cuda.Stream,
+        consumer_done: cp.cuda.Event,
+    ) -> tuple[Optional[tuple[Any, cp.ndarray]], cp.cuda.Event]:
+        """Runs in the background thread."""
+        with device, stream:
+            stream.wait_event(consumer_done)
+            try:
+                super_batch: Optional[tuple[Any, cp.ndarray]] = next(
+                    self._super_dataset
+                )
+            except StopIteration:
+                super_batch = None
+            return super_batch, stream.record()
+
+    def __iter__(self) -> Iterator[tuple[Any, cp.ndarray]]:
+        return self
+
+    def __next__(self) -> tuple[Any, cp.ndarray]:
+        if not self._started:
+            self.start()
+        if self._pending is None:
+            raise StopIteration
+        super_batch, ready = self._pending.result()
+        self._pending = None
+        if super_batch is None:
+            raise StopIteration
+        cp.cuda.get_current_stream().wait_event(ready)
+        self._schedule()
+        return super_batch
+
+
 class BigWigSuperDataset:
     """
     Dataset over FASTA files and BigWig profiles.
@@ -193,6 +384,7 @@ class BigWigSuperDataset:
         maximum_unknown_bases_fraction: maximum number of bases in an input sequence that
             is unknown.
         sequence_encoder: encoder to apply to the sequence. Default: bigwig_loader.util.onehot_sequences
+            When the encoder returns a numeric numpy array, it is copied to the GPU as a CuPy array.
         file_extensions: load files with these extensions (default .bw and .bigWig)
         crawl: whether to search in sub-directories for BigWig files
         scale: Optional, dictionary with scaling factors for each BigWig file.
@@ -206,6 +398,11 @@ class BigWigSuperDataset:
             of positions when the buffer runs out, but repeats the same samples. Can be used to
             check whether network can overfit.
         use_cufile: whether to use kvikio cuFile to directly load data from file to GPU memory.
+        target_dtype: floating point dtype of the target, cp.float16 halves its memory
+            footprint. The values are computed in float32 and converted at the end.
+            Default: cp.float32.
+        n_out_buffers: number of target buffers to rotate over. A returned target stays
+            valid for n_out_buffers - 1 subsequent batches. Default: 1.
     """
 
     def __init__(
@@ -230,6 +427,8 @@ class BigWigSuperDataset:
         position_sampler_buffer_size: int = 100000,
         repeat_same_positions: bool = False,
         use_cufile: bool = True,
+        target_dtype: npt.DTypeLike = cp.float32,
+        n_out_buffers: int = 1,
     ):
         super().__init__()
 
@@ -250,12 +449,11 @@ class BigWigSuperDataset:
             self.center_bin_to_predict = sequence_length
         self.window_size = window_size
         self.batch_size = batch_size
-        self.batches_per_epoch = (
-            batches_per_epoch
-            or (regions_of_interest["end"] - regions_of_interest["start"]).sum()
-            // sequence_length
-            // batch_size
-        )
+        if batches_per_epoch is None:
+            batches_per_epoch = _default_batches_per_epoch(
+                regions_of_interest, sequence_length, batch_size
+            )
+        self.batches_per_epoch = batches_per_epoch
         self._n = 0
         self.maximum_unknown_bases_fraction = maximum_unknown_bases_fraction
         self.sequence_encoder = sequence_encoder
@@ -264,13 +462,34 @@ class BigWigSuperDataset:
         self._crawl = crawl
         self._scale = scale
         self._genome: Optional[Genome] = None
-        self._prepared_out: Optional[cp.ndarray] = None
+        self._prepared_out: list[cp.ndarray] = []
+        self._prepared_target_out: list[cp.ndarray] = []
+        self._n_out_buffers = n_out_buffers
+        self._out_index = 0
         self._position_sampler_buffer_size = position_sampler_buffer_size
         self._repeat_same_positions = repeat_same_positions
         self._moving_average_window_size = moving_average_window_size
         self._use_cufile = use_cufile
+        self.target_dtype = cp.dtype(target_dtype)
+        if self.target_dtype.kind != "f":
+            raise ValueError(
+                f"target_dtype should be a floating point dtype, not {self.target_dtype}"
+            )
+        self._start = np.empty(batch_size, dtype=np.int64)
+        self._end = np.empty(batch_size, dtype=np.int64)
+        self._pinned_sequences: Optional[npt.NDArray[Any]] = None
+        self._sequence_copy_stream: Optional[cp.cuda.Stream] = None
+        self._sequences_copied: Optional[cp.cuda.Event] = None
 
     def reset_gpu(self) -> None:
+        """
+        Recreate the GPU state on the current device. The BigWigCollection can
+        be shared with other datasets, which are moved to this device as well.
+        """
+        self._prepared_out = []
+        self._prepared_target_out = []
+        self._sequence_copy_stream = None
+        self._sequences_copied = None
         self.bigwig_collection.reset_gpu()
 
     @property
@@ -305,7 +524,7 @@ class BigWigSuperDataset:
             return self._bigwig_collection
 
         elif self._bigwig_path is not None:
-            self._bigwig_collection = BigWigCollection(
+            self._bigwig_collection = _shared_collection(
                 self._bigwig_path,
                 file_extensions=self._file_extensions,
                 crawl=self._crawl,
@@ -319,37 +538,145 @@ class BigWigSuperDataset:
                 f"{self}._bigwig_collection and {self}._bigwig_path are bot None. At least one should be set."
             )
 
+    @property
+    def _out_shape(self) -> tuple[int, int, int]:
+        return (
+            len(self.bigwig_collection),
+            self.batch_size,
+            self.center_bin_to_predict // self.window_size,
+        )
+
     @property
     def _out(self) -> cp.ndarray:
-        if self._prepared_out is None:
-            self._prepared_out = cp.zeros(
-                (
-                    len(self.bigwig_collection),
-                    self.batch_size,
-                    self.center_bin_to_predict // self.window_size,
-                ),
-                dtype=cp.float32,
+        """
+        Buffer the target is written to. It is not zero initialized, because
+        intervals_to_values fills it with zeros before writing the values.
+        Reallocated when the shape of the target changes.
+        """
+        shape = self._out_shape
+        if self._prepared_out and self._prepared_out[0].shape != shape:
+            self._prepared_out = []
+        if not self._prepared_out:
+            self._prepared_out = [
+                cp.empty(shape, dtype=cp.float32) for _ in range(self._n_out_buffers)
+            ]
+        return self._prepared_out[self._out_index]
+
+    @property
+    def _target_out(self) -> cp.ndarray:
+        """
+        Buffer of target_dtype the (smoothed) target in _out is written to,
+        when it needs smoothing or conversion.
+        """
+        shape = self._out_shape
+        if self._prepared_target_out and (
+            self._prepared_target_out[0].shape != shape
+            or self._prepared_target_out[0].dtype != self.target_dtype
+        ):
+            self._prepared_target_out = []
+        if not self._prepared_target_out:
+            self._prepared_target_out = [
+                cp.empty(shape, dtype=self.target_dtype)
+                for _ in range(self._n_out_buffers)
+            ]
+        return self._prepared_target_out[self._out_index]
+
+    @property
+    def sequence_copy_stream(self) -> cp.cuda.Stream:
+        if self._sequence_copy_stream is None:
+            self._sequence_copy_stream = cp.cuda.Stream(non_blocking=True)
+        return self._sequence_copy_stream
+
+    def _sequences_to_gpu(self, sequences: Any) -> Any:
+        """
+        Start copying encoded sequences to the GPU. They are written to a
+        reused pinned memory buffer first, from which they are copied
+        asynchronously on a separate stream, so that the copy runs while
+        the targets are loaded. Sequences that are not numeric numpy arrays
+        (for instance strings when no encoder is used) are returned as they are.
+        """
+        encoded = sequences
+        if isinstance(sequences, list):
+            if not sequences or isinstance(sequences[0], str):
+                # no encoder, don't build a large string array to find out
+                return sequences
+            # for instance custom encoders returning nested lists of numbers
+            try:
+                encoded = np.asarray(sequences)
+            except ValueError:
+                return sequences
+        if not isinstance(encoded, np.ndarray) or encoded.dtype.kind not in "biuf":
+            return sequences
+        sequences = encoded
+        if (
+            self._pinned_sequences is None
+            or self._pinned_sequences.shape != sequences.shape
+            or self._pinned_sequences.dtype != sequences.dtype
+        ):
+            pinned_memory = cp.cuda.alloc_pinned_memory(sequences.nbytes)
+            self._pinned_sequences = np.frombuffer(
+                pinned_memory, dtype=sequences.dtype, count=sequences.size
+            ).reshape(sequences.shape)
+        if self._sequences_copied is not None:
+            # the previous copy from the pinned buffer might still be running
+            self._sequences_copied.synchronize()
+        self._pinned_sequences[...] = sequences
+        # Allocate on the caller's stream, so the memory pool only hands out
+        # memory that is no longer in use on that stream, and let the copy
+        # wait until the caller's stream got there.
+        gpu_sequences = cp.empty(sequences.shape, dtype=sequences.dtype)
+        stream = self.sequence_copy_stream
+        stream.wait_event(cp.cuda.get_current_stream().record())
+        with stream:
+            gpu_sequences.data.copy_from_host_async(
+                self._pinned_sequences.ctypes.data, sequences.nbytes, stream=stream
             )
-        return self._prepared_out
+            self._sequences_copied = stream.record()
+        return gpu_sequences
 
     def __iter__(self) -> Iterator[tuple[Any, cp.ndarray]]:
         self._n = 0
         return self
 
+    def _get_target(self, chromosomes: list[str]) -> cp.ndarray:
+        """
+        Load the target for the positions in self._start and self._end
+        and smooth and/or convert it when needed.
+        """
+        out = self._out
+        target = self.bigwig_collection.get_batch(
+            chromosomes,
+            self._start,
+            self._end,
+            window_size=self.window_size,
+            out=out,
+        )
+        if self._moving_average_window_size != 1:
+            # smooth the contiguous (n_files, batch_size, bins) buffer
+            # in one kernel and transpose like get_batch does.
+            smoothed = moving_average(
+                out, self._moving_average_window_size, out=self._target_out
+            )
+            target = cp.transpose(smoothed, (1, 0, 2))
+        elif self.target_dtype != out.dtype:
+            converted = self._target_out
+            cp.copyto(converted, out)
+            target = cp.transpose(converted, (1, 0, 2))
+        return target
+
     def __next__(self) -> tuple[Any, cp.ndarray]:
         if self._n < self.batches_per_epoch:
             self._n += 1
-            positions, sequences = self.genome.get_batch()
-            chromosomes, center = zip(*positions)
-            start = np.array(center) - (self.center_bin_to_predict // 2)
-            end = start + self.center_bin_to_predict
-            target = self.bigwig_collection.get_batch(
-                chromosomes,
-                start,
-                end,
-                window_size=self.window_size,
-                out=self._out,
-            )
-            target = moving_average(target, self._moving_average_window_size)
+            chromosomes, centers, sequences = self.genome.get_batch()
+            np.subtract(centers, self.center_bin_to_predict // 2, out=self._start)
+            np.add(self._start, self.center_bin_to_predict, out=self._end)
+
+            # Start the (asynchronous) copy of the sequences to the GPU first,
+            # so it runs while the target is loaded.
+            sequences = self._sequences_to_gpu(sequences)
+            target = self._get_target(chromosomes)
+            if isinstance(sequences, cp.ndarray):
+                cp.cuda.get_current_stream().wait_event(self._sequences_copied)
+            self._out_index = (self._out_index + 1) % self._n_out_buffers
             return sequences, target
         raise StopIteration
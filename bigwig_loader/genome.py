@@ -8,6 +8,8 @@ from typing import Sequence
 from typing import Union
 
 import fsspec
+import numpy as np
+import numpy.typing as npt
 from pyfaidx import Fasta
 
 from bigwig_loader.util import fraction_non_standard
@@ -36,10 +38,19 @@ class Genome:
         self.maximum_unknown_bases_fraction = maximum_unknown_bases_fraction
         self.encoder = self._select_encoder(encoder)
 
-    def get_batch(self) -> tuple[list[tuple[str, int]], Any]:
-        selected_positions: list[tuple[str, int]] = []
+    def get_batch(self) -> tuple[list[str], npt.NDArray[np.int64], Any]:
+        """
+        Get a batch of sequences around positions taken from the position
+        sampler, skipping positions with too many unknown bases.
+        Returns:
+            Tuple(chromosomes of the selected positions,
+                  numpy array with the centers of the selected positions,
+                  (encoded) sequences)
+        """
+        chromosomes: list[str] = []
+        centers = np.empty(self.batch_size, dtype=np.int64)
         sequences = []
-        while len(selected_positions) < self.batch_size:
+        while len(chromosomes) < self.batch_size:
             chromosome, center = next(self.position_sampler)
             start = center - (self.sequence_length // 2)
             end = start + self.sequence_length
@@ -51,10 +62,11 @@ class Genome:
             if fraction_non_standard(sequence) > self.maximum_unknown_bases_fraction:
                 continue
             sequences.append(sequence)
-            selected_positions.append((chromosome, center))
+            centers[len(chromosomes)] = center
+            chromosomes.append(chromosome)
         if self.encoder is not None:
             sequences = self.encoder(sequences)
-        return selected_positions, sequences
+        return chromosomes, centers, sequences
 
     def _get_sequence(
         self, chrom: str, start: int, end: int, strand: Literal["+", "-"] = "+"
@@ -5,8 +5,6 @@ import cupy as cp
 
 ROUTE_KERNELS = True
 
-_zero = cp.asarray(0.0, dtype=cp.float32).item()
-
 _cuda_kernel = """
 extern "C" __global__
 void intervals_to_values(
@@ -130,7 +128,7 @@ def intervals_to_values(
     out: cp.ndarray,
     window_size: int = 1,
 ) -> cp.ndarray:
-    out *= _zero
+    out.fill(0)
     found_starts = cp.searchsorted(track_ends, query_starts, side="right").astype(
         dtype=cp.int32
     )
@@ -5,11 +5,52 @@ from typing import Optional
 from typing import Union
 
 import cupy as cp
+import kvikio
+import kvikio.defaults
 import numpy as np
+import numpy.typing as npt
 from kvikio.cufile import CuFile
 from kvikio.cufile import IOFuture
 
 
+def cufile_compat_mode() -> bool:
+    """
+    Whether kvikio runs in compatibility mode. In that case kvikio stages all
+    reads through host memory itself instead of using GPUDirect Storage to go
+    from storage to GPU memory directly.
+    """
+    # Newer kvikio versions return a CompatMode enum from compat_mode(), of
+    # which the default AUTO is truthy, and resolve it with
+    # is_compat_mode_preferred(). Older versions return a bool.
+    is_compat_mode_preferred = getattr(
+        kvikio.defaults, "is_compat_mode_preferred", None
+    )
+    if is_compat_mode_preferred is not None:
+        return bool(is_compat_mode_preferred())
+    return bool(kvikio.defaults.compat_mode())
+
+
+def coalesce_chunks(
+    offsets: npt.NDArray[np.int64], sizes: npt.NDArray[np.int64]
+) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    """
+    Group chunks that directly follow each other in a file into runs,
+    so that every run can be read at once.
+    Args:
+        offsets: byte offsets to starts of chunks
+        sizes: byte sizes of chunks
+    Returns:
+        Tuple(byte offsets of the runs, byte sizes of the runs,
+              for every chunk the index of the run it is part of)
+    """
+    starts_run = np.ones(len(offsets), dtype=bool)
+    starts_run[1:] = offsets[1:] != offsets[:-1] + sizes[:-1]
+    run_ids = np.cumsum(starts_run) - 1
+    run_offsets = offsets[starts_run]
+    run_ends = np.maximum.reduceat(offsets + sizes, np.flatnonzero(starts_run))
+    return run_offsets, run_ends - run_offsets, run_ids
+
+
 class RAMMemoryBank:
     def __init__(self, nbytes: int = 10000, elastic: bool = True):
         self._default_nbytes = nbytes
@@ -19,6 +60,7 @@ class RAMMemoryBank:
         self._current_file_handle: Optional[BinaryIO] = None
         self.n_chunks = 0
         self.compressed_chunk_sizes: list[int] = []
+        self.compressed_chunk_starts: list[int] = []
         self.compressed_chunk_offsets: list[int] = [0]
         self.cumulative_n_chunks_per_file: list[int] = []
         self.elastic = elastic
@@ -31,6 +73,7 @@ class RAMMemoryBank:
         self._current_file_handle = None
         self.n_chunks = 0
         self.compressed_chunk_sizes = []
+        self.compressed_chunk_starts = []
         self.compressed_chunk_offsets = [0]
         self.cumulative_n_chunks_per_file = []
 
@@ -72,25 +115,7 @@ class RAMMemoryBank:
         Returns:
 
         """
-        # cast this to python int because when it's uint64 and we add/subtract
-        # skip_bytes, it somehow becomes float64, which we don't want.
-        offset = int(offset)
-        size = int(size)
-        offset += skip_bytes
-        size -= skip_bytes
-        if file_handle is not self._current_file_handle:
-            self.cumulative_n_chunks_per_file.append(self.n_chunks)
-            self._current_file_handle = file_handle
-        self.n_chunks += 1
-        current_offset = self.compressed_chunk_offsets[-1]
-        new_offset = current_offset + size
-        file_handle.seek(offset)
-        # file_handle.readinto(self._view[current_offset:new_offset])
-        if self.elastic:
-            self.increase_memory_size(new_offset)
-        file_handle.readinto(self._view[current_offset:new_offset])  # type: ignore
-        self.compressed_chunk_offsets.append(new_offset)
-        self.compressed_chunk_sizes.append(size)
+        self.add_many(file_handle, [offset], [size], skip_bytes=skip_bytes)
 
     def add_many(
         self,
@@ -100,28 +125,42 @@ class RAMMemoryBank:
         skip_bytes: int = 2,
     ) -> None:
         """
-        Add many compressed chunks from a single file.
+        Add many compressed chunks from a single file. Chunks that directly
+        follow each other in the file are read with a single read.
         Args:
             file_handle: opened file
             offsets: byte offsets to starts of compressed chunks
             sizes: sizes of compressed chunks
             skip_bytes: skips this number of bytes from offset
-            increase_memory_size: whether to elastically increase the
-                size of the pinned memory if the new chunks don't
-                fit in anymore. (default: True)
 
         """
-        new_size = self.compressed_chunk_offsets[-1] + sum(sizes)
+        chunk_offsets = np.asarray(offsets, dtype=np.int64)
+        chunk_sizes = np.asarray(sizes, dtype=np.int64)
+        if not len(chunk_offsets):
+            return
+        run_offsets, run_sizes, run_ids = coalesce_chunks(chunk_offsets, chunk_sizes)
+        write_offset = self.compressed_chunk_offsets[-1]
         if self.elastic:
             # better increase once for an entire batch than separately for each chunk
-            self.increase_memory_size(new_size)
-        for offset, size in zip(offsets, sizes):
-            self.add(
-                file_handle,
-                offset,
-                size,
-                skip_bytes=skip_bytes,
-            )
+            self.increase_memory_size(write_offset + int(run_sizes.sum()))
+        run_positions = write_offset + np.cumsum(run_sizes) - run_sizes
+        for run_offset, run_size, position in zip(
+            run_offsets.tolist(), run_sizes.tolist(), run_positions.tolist()
+        ):
+            file_handle.seek(run_offset)
+            file_handle.readinto(self._view[position : position + run_size])  # type: ignore
+        chunk_starts = (
+            run_positions[run_ids] + (chunk_offsets - run_offsets[run_ids]) + skip_bytes
+        )
+        if file_handle is not self._current_file_handle:
+            self.cumulative_n_chunks_per_file.append(self.n_chunks)
+            self._current_file_handle = file_handle
+        self.n_chunks += len(chunk_offsets)
+        self.compressed_chunk_starts.extend(chunk_starts.tolist())
+        self.compressed_chunk_sizes.extend((chunk_sizes - skip_bytes).tolist())
+        self.compressed_chunk_offsets.extend(
+            (chunk_starts + chunk_sizes - skip_bytes).tolist()
+        )
 
     def to_gpu(self) -> tuple[cp.ndarray, cp.ndarray]:
         """
@@ -131,8 +170,7 @@ class RAMMemoryBank:
                   chunks, sizes of compressed chunks)
         """
         compressed_chunk_sizes = cp.array(self.compressed_chunk_sizes, dtype=cp.uint64)
-        # offsets = cp.array(self.compressed_chunk_offsets[:-1], dtype=cp.uint64)
-        offsets = cp.pad(cp.cumsum(compressed_chunk_sizes), (1, 0))[:-1]
+        offsets = cp.array(self.compressed_chunk_starts, dtype=cp.uint64)
 
         cpu_array = np.frombuffer(
             self._mem, dtype="byte", count=self.compressed_chunk_offsets[-1]
@@ -149,10 +187,15 @@ class RAMMemoryBank:
 class CuFileMemoryBank:
     def __init__(self, nbytes: int = 10000, elastic: bool = True):
         self._default_nbytes = nbytes
-        self._gpu_byte_array = cp.empty(nbytes, dtype=cp.uint8)
+        # Registering the device buffer with cuFile saves cuFile from
+        # registering it internally on every single read. In compatibility
+        # mode there is no GPUDirect Storage, so nothing to register.
+        self._register_memory = not cufile_compat_mode()
+        self._gpu_byte_array = self._allocate(nbytes)
         self._current_file_handle: CuFile = None
         self.n_chunks = 0
         self.compressed_chunk_sizes: list[int] = []
+        self.compressed_chunk_starts: list[int] = []
         self.compressed_chunk_offsets: list[int] = [0]
         self.cumulative_n_chunks_per_file: list[int] = []
         self.elastic = elastic
@@ -166,16 +209,52 @@ class CuFileMemoryBank:
         self._current_file_handle = None
         self.n_chunks = 0
         self.compressed_chunk_sizes = []
+        self.compressed_chunk_starts = []
         self.compressed_chunk_offsets = [0]
         self.cumulative_n_chunks_per_file = []
         self._promises = []
-        self._gpu_byte_array *= 0
+
+    def _allocate(self, nbytes: int) -> cp.ndarray:
+        """
+        Allocate a device byte array to read into and register it with cuFile.
+        """
+        gpu_byte_array = cp.empty(nbytes, dtype=cp.uint8)
+        if self._register_memory:
+            kvikio.memory_register(gpu_byte_array)
+        return gpu_byte_array
+
+    def _free(self, gpu_byte_array: cp.ndarray) -> None:
+        """
+        Deregister a device byte array from cuFile, after which it can be
+        garbage collected.
+        """
+        if self._register_memory:
+            kvikio.memory_deregister(gpu_byte_array)
+
+    def deregister_memory(self) -> None:
+        """
+        Deregister the device memory from cuFile. Should be called before
+        this memory bank is discarded, for instance when moving to another gpu.
+        """
+        self.await_all_promises()
+        self._free(self._gpu_byte_array)
+        self._register_memory = False
+
+    def __del__(self) -> None:
+        # Pending reads still write into the buffer and cuFile keeps the
+        # registration alive, so both need to be finished before it is freed.
+        if getattr(self, "_register_memory", False) and hasattr(
+            self, "_gpu_byte_array"
+        ):
+            self.deregister_memory()
 
     def shrink(self) -> None:
         """
         Shrink the pinned memory to the minimum size.
         """
-        self._gpu_byte_array = cp.empty(self._default_nbytes, dtype=cp.uint8)
+        self.await_all_promises()
+        self._free(self._gpu_byte_array)
+        self._gpu_byte_array = self._allocate(self._default_nbytes)
 
     def await_all_promises(self) -> list[int]:
         """
@@ -201,15 +280,19 @@ class CuFileMemoryBank:
             logging.debug(
                 f"CuFileMemoryBank: Increasing size of cupy byte from {self._gpu_byte_array.size} to {new_size}"
             )
-            new_mem = cp.empty(new_size, dtype=cp.uint8)
+            new_mem = self._allocate(new_size)
             new_mem[: self._gpu_byte_array.size] = self._gpu_byte_array
+            # The preads are not ordered on the stream, the copy must be done
+            # before they write into new_mem.
+            cp.cuda.get_current_stream().synchronize()
+            self._free(self._gpu_byte_array)
             self._gpu_byte_array = new_mem
 
     def add(
         self, file_handle: CuFile, offset: int, size: int, skip_bytes: int = 2
     ) -> None:
         """
-        Add one compressed chunk to the pinned memory.
+        Add one compressed chunk to the gpu memory.
         Args:
             file_handle: opened file
             offset: byte offset to start of compressed chunk
@@ -218,30 +301,7 @@ class CuFileMemoryBank:
         Returns:
 
         """
-        # cast this to python int because when it's uint64 and we add/subtract
-        # skip_bytes, it somehow becomes float64, which we don't want.
-        offset = int(offset)
-        size = int(size)
-        offset += skip_bytes
-        size -= skip_bytes
-        if file_handle is not self._current_file_handle:
-            self.cumulative_n_chunks_per_file.append(self.n_chunks)
-            self._current_file_handle = file_handle
-        self.n_chunks += 1
-
-        current_offset = self.compressed_chunk_offsets[-1]
-        new_offset = current_offset + size
-
-        if self.elastic:
-            self.increase_memory_size(new_offset)
-        promise = file_handle.pread(
-            buf=self._gpu_byte_array[current_offset:new_offset],
-            size=size,
-            file_offset=offset,
-        )
-        self._promises.append(promise)
-        self.compressed_chunk_offsets.append(new_offset)
-        self.compressed_chunk_sizes.append(size)
+        self.add_many(file_handle, [offset], [size], skip_bytes=skip_bytes)
 
     def add_many(
         self,
@@ -251,28 +311,46 @@ class CuFileMemoryBank:
         skip_bytes: int = 2,
     ) -> None:
         """
-        Add many compressed chunks from a single file.
+        Add many compressed chunks from a single file. Chunks that directly
+        follow each other in the file are read with a single read.
         Args:
             file_handle: opened file
             offsets: byte offsets to starts of compressed chunks
             sizes: sizes of compressed chunks
             skip_bytes: skips this number of bytes from offset
-            increase_memory_size: whether to elastically increase the
-                size of the pinned memory if the new chunks don't
-                fit in anymore. (default: True)
 
         """
-        new_size = self.compressed_chunk_offsets[-1] + sum(sizes)
+        chunk_offsets = np.asarray(offsets, dtype=np.int64)
+        chunk_sizes = np.asarray(sizes, dtype=np.int64)
+        if not len(chunk_offsets):
+            return
+        run_offsets, run_sizes, run_ids = coalesce_chunks(chunk_offsets, chunk_sizes)
+        write_offset = self.compressed_chunk_offsets[-1]
         if self.elastic:
             # better increase once for an entire batch than separately for each chunk
-            self.increase_memory_size(new_size)
-        for offset, size in zip(offsets, sizes):
-            self.add(
-                file_handle,
-                offset,
-                size,
-                skip_bytes=skip_bytes,
+            self.increase_memory_size(write_offset + int(run_sizes.sum()))
+        run_positions = write_offset + np.cumsum(run_sizes) - run_sizes
+        for run_offset, run_size, position in zip(
+            run_offsets.tolist(), run_sizes.tolist(), run_positions.tolist()
+        ):
+            promise = file_handle.pread(
+                buf=self._gpu_byte_array[position : position + run_size],
+                size=run_size,
+                file_offset=run_offset,
             )
+            self._promises.append(promise)
+        chunk_starts = (
+            run_positions[run_ids] + (chunk_offsets - run_offsets[run_ids]) + skip_bytes
+        )
+        if file_handle is not self._current_file_handle:
+            self.cumulative_n_chunks_per_file.append(self.n_chunks)
+            self._current_file_handle = file_handle
+        self.n_chunks += len(chunk_offsets)
+        self.compressed_chunk_starts.extend(chunk_starts.tolist())
+        self.compressed_chunk_sizes.extend((chunk_sizes - skip_bytes).tolist())
+        self.compressed_chunk_offsets.extend(
+            (chunk_starts + chunk_sizes - skip_bytes).tolist()
+        )
 
     def to_gpu(self) -> tuple[cp.ndarray, cp.ndarray]:
         """
@@ -282,8 +360,7 @@ class CuFileMemoryBank:
                   chunks, sizes of compressed chunks)
         """
         compressed_chunk_sizes = cp.array(self.compressed_chunk_sizes, dtype=cp.uint64)
-        # offsets = cp.array(self.compressed_chunk_offsets[:-1], dtype=cp.uint64)
-        offsets = cp.pad(cp.cumsum(compressed_chunk_sizes), (1, 0))[:-1]
+        offsets = cp.array(self.compressed_chunk_starts, dtype=cp.uint64)
         self.await_all_promises()
         comp_chunk_pointers = offsets + self._gpu_byte_array.data.ptr
         return comp_chunk_pointers, compressed_chunk_sizes
@@ -1,6 +1,7 @@
 from typing import Iterator
 
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
 
 from bigwig_loader.util import make_cumulative_index_intervals
@@ -17,7 +18,7 @@ class PositionSampler:
         self.buffer_size = buffer_size
         self._max_index = self.regions_of_interest.index[-1]
         self._chromosomes: list[str] = []
-        self._centers: list[int] = []
+        self._centers: npt.NDArray[np.int64] = np.empty(0, dtype=np.int64)
         self._index = 0
         self._repeat_same = repeat_same
 
@@ -28,7 +29,7 @@ class PositionSampler:
         if self._index >= self.buffer_size:
             self._index = 0
         if self._index == 0:
-            if not self._repeat_same or not self._centers:
+            if not self._repeat_same or not len(self._centers):
                 self._refresh_buffer()
         chromosome = self._chromosomes[self._index]
         center = self._centers[self._index]
@@ -42,7 +43,8 @@ class PositionSampler:
         containing_intervals = self.regions_of_interest.iloc[
             self.regions_of_interest.index.searchsorted(batch_rand) - 1  # type: ignore
         ]
-        self._centers = list(
-            containing_intervals["start"] + (batch_rand - containing_intervals.index)
-        )
-        self._chromosomes = list(containing_intervals["chrom"])
+        self._centers = (
+            containing_intervals["start"].to_numpy()
+            + (batch_rand - containing_intervals.index.to_numpy())
+        ).astype(np.int64)
+        self._chromosomes = containing_intervals["chrom"].tolist()
@@ -2,6 +2,8 @@ from typing import Iterable
 from typing import Optional
 from typing import Sequence
 
+import numpy as np
+import numpy.typing as npt
 import pandas as pd
 from natsort import natsort_keygen
 from natsort import natsorted
@@ -54,6 +56,14 @@ _string_to_encoding = {
 
 _standard_bases = {"A", "C", "G", "T"}
 
+# lookup tables from ascii code to encoding, used to encode
+# all bases in a batch at once.
+_byte_to_encoding = np.zeros((256, 4), dtype=np.float32)
+_known_bytes = np.zeros(256, dtype=bool)
+for _base, _encoding in _string_to_encoding.items():
+    _byte_to_encoding[ord(_base)] = _encoding
+    _known_bytes[ord(_base)] = True
+
 
 def fraction_non_standard(sequence: str) -> float:
     standard_bases = _standard_bases
@@ -64,8 +74,28 @@ def fraction_non_standard(sequence: str) -> float:
     return n_non_standard / len(sequence)
 
 
-def onehot_sequences(sequences: Sequence[str]) -> list[list[list[float]]]:
-    return [[_string_to_encoding[base] for base in sequence] for sequence in sequences]
+def onehot_sequences(sequences: Sequence[str]) -> npt.NDArray[np.float32]:
+    """
+    Onehot encode a batch of sequences of equal length.
+    Args:
+        sequences: DNA sequences, may contain IUPAC ambiguity codes.
+    Returns:
+        numpy array of shape (number of sequences, sequence length, 4)
+    """
+    if not sequences:
+        return np.zeros((0, 0, 4), dtype=np.float32)
+    sequence_length = len(sequences[0])
+    if any(len(sequence) != sequence_length for sequence in sequences):
+        raise ValueError("All sequences should have the same length.")
+    byte_matrix = np.frombuffer(
+        "".join(sequences).encode("ascii"), dtype=np.uint8
+    ).reshape(len(sequences), sequence_length)
+    if not _known_bytes[byte_matrix].all():
+        unknown = {
+            chr(byte) for byte in np.unique(byte_matrix[~_known_bytes[byte_matrix]])
+        }
+        raise ValueError(f"Can not onehot encode unknown bases {unknown}.")
+    return _byte_to_encoding[byte_matrix]
 
 
 def chromosome_sort(chromosomes: Iterable[str]) -> list[str]:
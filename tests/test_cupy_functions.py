@@ -1,4 +1,5 @@
 import cupy as cp
+import pytest
 
 from bigwig_loader.cupy_functions import moving_average
 
@@ -8,3 +9,45 @@ def test_correct_shape():
     result = moving_average(array, 8)
     print(result)
     assert result.shape == array.shape
+
+
+def test_same_as_convolve():
+    array = cp.random.rand(3, 4, 30).astype(cp.float32)
+    for window_size in [2, 3, 8]:
+        kernel = cp.ones(window_size) / window_size
+        expected = cp.apply_along_axis(
+            lambda m: cp.convolve(m, kernel, mode="same"), axis=-1, arr=array
+        )
+        result = moving_average(array, window_size)
+        cp.testing.assert_allclose(result, expected, rtol=1e-5)
+
+
+def test_to_preallocated_out():
+    array = cp.random.rand(3, 4, 30).astype(cp.float32)
+    out = cp.empty_like(array)
+    result = moving_average(array, 5, out=out)
+    assert result is out
+
+
+def test_convert_dtype():
+    array = cp.random.rand(3, 4, 30).astype(cp.float32)
+    out = cp.empty(array.shape, dtype=cp.float16)
+    result = moving_average(array, 5, out=out)
+    assert result is out
+    assert result.dtype == cp.float16
+    cp.testing.assert_allclose(result, moving_average(array, 5), rtol=1e-2)
+
+
+def test_window_size_one_writes_to_out():
+    array = cp.random.rand(3, 4, 30).astype(cp.float32)
+    out = cp.empty(array.shape, dtype=cp.float16)
+    result = moving_average(array, 1, out=out)
+    assert result is out
+    cp.testing.assert_allclose(result, array, rtol=1e-2)
+
+
+def test_out_with_wrong_shape():
+    array = cp.random.rand(3, 4, 30).astype(cp.float32)
+    out = cp.empty((4, 3, 30), dtype=cp.float32)
+    with pytest.raises(ValueError, match="same shape"):
+        moving_average(array, 5, out=out)
@@ -23,3 +23,140 @@ def pytorch_dataset(bigwig_path, reference_genome_path, merged_intervals):
 def test_output_shape(pytorch_dataset):
     for sequence, target in pytorch_dataset:
         assert target.shape == (256, 2, 250)
+
+
+def test_output_shape_with_super_batches(
+    bigwig_path, reference_genome_path, merged_intervals
+):
+    from bigwig_loader.dataset import BigWigDataset
+
+    dataset = BigWigDataset(
+        regions_of_interest=merged_intervals,
+        collection=bigwig_path,
+        reference_genome_path=reference_genome_path,
+        sequence_length=2000,
+        center_bin_to_predict=1000,
+        window_size=4,
+        batch_size=64,
+        super_batch_size=128,
+        batches_per_epoch=5,
+        maximum_unknown_bases_fraction=0.1,
+        first_n_files=2,
+    )
+    for _ in range(2):
+        n_batches = 0
+        for sequence, target in dataset:
+            assert target.shape == (64, 2, 250)
+            n_batches += 1
+        assert n_batches == 5
+
+
+def test_onehot_sequences_on_gpu(pytorch_dataset):
+    import cupy as cp
+
+    sequence, target = next(iter(pytorch_dataset))
+    assert isinstance(sequence, cp.ndarray)
+    assert sequence.shape == (256, 2000, 4)
+
+
+def test_float16_target(bigwig_path, reference_genome_path, merged_intervals):
+    import cupy as cp
+
+    from bigwig_loader.dataset import BigWigDataset
+
+    dataset = BigWigDataset(
+        regions_of_interest=merged_intervals,
+        collection=bigwig_path,
+        reference_genome_path=reference_genome_path,
+        sequence_length=2000,
+        center_bin_to_predict=1000,
+        window_size=4,
+        moving_average_window_size=5,
+        batch_size=256,
+        batches_per_epoch=2,
+        maximum_unknown_bases_fraction=0.1,
+        first_n_files=2,
+        target_dtype=cp.float16,
+    )
+    for sequence, target in dataset:
+        assert target.shape == (256, 2, 250)
+        assert target.dtype == cp.float16
+
+
+def test_collection_is_shared(bigwig_path, reference_genome_path, merged_intervals):
+    from bigwig_loader.dataset import BigWigSuperDataset
+
+    datasets = [
+        BigWigSuperDataset(
+            regions_of_interest=merged_intervals,
+            collection=bigwig_path,
+            reference_genome_path=reference_genome_path,
+            first_n_files=2,
+        )
+        for _ in range(2)
+    ]
+    assert datasets[0].bigwig_collection is datasets[1].bigwig_collection
+
+
+def test_super_batch_size_smaller_than_batch_size(
+    bigwig_path, reference_genome_path, merged_intervals
+):
+    from bigwig_loader.dataset import BigWigDataset
+
+    with pytest.raises(ValueError, match=r"super_batch_size \(128\)"):
+        BigWigDataset(
+            regions_of_interest=merged_intervals,
+            collection=bigwig_path,
+            reference_genome_path=reference_genome_path,
+            batch_size=256,
+            super_batch_size=128,
+        )
+
+
+def test_prefetched_batches_match_super_dataset(
+    bigwig_path, reference_genome_path, merged_intervals, use_cufile
+):
+    import cupy as cp
+    import numpy as np
+
+    from bigwig_loader.dataset import BigWigSuperDataset
+    from bigwig_loader.dataset import _PrefetchSuperBatch
+
+    def create_dataset(n_out_buffers):
+        return BigWigSuperDataset(
+            regions_of_interest=merged_intervals,
+            collection=bigwig_path,
+            reference_genome_path=reference_genome_path,
+            sequence_length=2000,
+            center_bin_to_predict=1000,
+            window_size=4,
+            batch_size=128,
+            batches_per_epoch=4,
+            first_n_files=2,
+            use_cufile=use_cufile,
+            n_out_buffers=n_out_buffers,
+        )
+
+    np.random.seed(56)
+    expected = [
+        (cp.asnumpy(sequences), cp.asnumpy(target))
+        for sequences, target in create_dataset(n_out_buffers=1)
+    ]
+
+    np.random.seed(56)
+    busy = cp.random.rand(2048, 2048, dtype=cp.float32)
+    with cp.cuda.Stream(non_blocking=True):
+        prefetcher = _PrefetchSuperBatch(create_dataset(n_out_buffers=2))
+        n_batches = 0
+        for (sequences, target), (expected_sequences, expected_target) in zip(
+            prefetcher, expected
+        ):
+            np.testing.assert_array_equal(cp.asnumpy(sequences), expected_sequences)
+            np.testing.assert_array_equal(cp.asnumpy(target), expected_target)
+            n_batches += 1
+            # keep the consumer's stream busy when the next batch is requested,
+            # so the prefetch stream is held up while its reads go ahead.
+            for _ in range(20):
+                busy = busy @ busy
+                busy /= cp.linalg.norm(busy)
+    assert n_batches == len(expected) == 4
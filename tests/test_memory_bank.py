@@ -0,0 +1,43 @@
+import enum
+
+import kvikio.defaults
+import numpy as np
+import pytest
+
+from bigwig_loader.memory_bank import coalesce_chunks
+from bigwig_loader.memory_bank import cufile_compat_mode
+
+
+def test_coalesce_chunks():
+    offsets = np.array([0, 10, 25, 40, 45, 100])
+    sizes = np.array([10, 15, 5, 5, 20, 3])
+    run_offsets, run_sizes, run_ids = coalesce_chunks(offsets, sizes)
+    assert run_offsets.tolist() == [0, 40, 100]
+    assert run_sizes.tolist() == [30, 25, 3]
+    assert run_ids.tolist() == [0, 0, 0, 1, 1, 2]
+
+
+class _CompatMode(enum.Enum):
+    OFF = 0
+    ON = 1
+    AUTO = 2
+
+
+@pytest.mark.parametrize("preferred", [True, False])
+def test_cufile_compat_mode_enum_api(monkeypatch, preferred):
+    monkeypatch.setattr(
+        kvikio.defaults, "compat_mode", lambda: _CompatMode.AUTO, raising=False
+    )
+    monkeypatch.setattr(
+        kvikio.defaults, "is_compat_mode_preferred", lambda: preferred, raising=False
+    )
+    assert cufile_compat_mode() is preferred
+
+
+@pytest.mark.parametrize("compat_mode", [True, False])
+def test_cufile_compat_mode_bool_api(monkeypatch, compat_mode):
+    monkeypatch.delattr(kvikio.defaults, "is_compat_mode_preferred", raising=False)
+    monkeypatch.setattr(
+        kvikio.defaults, "compat_mode", lambda: compat_mode, raising=False
+    )
+    assert cufile_compat_mode() is compat_mode
@@ -30,3 +30,10 @@ def test_input_and_target_is_torch_tensor(pytorch_dataset):
     sequence, target = next(iter(pytorch_dataset))
     assert isinstance(sequence, torch.Tensor)
     assert isinstance(target, torch.Tensor)
+
+
+def test_input_and_target_are_on_gpu(pytorch_dataset):
+    sequence, target = next(iter(pytorch_dataset))
+    assert sequence.is_cuda
+    assert target.is_cuda
+    assert sequence.dtype == torch.float32
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from bigwig_loader.util import _string_to_encoding
+from bigwig_loader.util import onehot_sequences
+
+
+def test_onehot_sequences():
+    sequences = ["AAAAATTTTACGT", "CAGAATTGTACGN", "RYKMSWBDHVNNA"]
+    expected = np.array(
+        [[_string_to_encoding[base] for base in sequence] for sequence in sequences],
+        dtype=np.float32,
+    )
+    result = onehot_sequences(sequences)
+    assert result.shape == (3, 13, 4)
+    assert result.dtype == np.float32
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_onehot_sequences_unknown_base():
+    with pytest.raises(ValueError):
+        onehot_sequences(["ACGTX"])
+
+
+def test_onehot_sequences_different_lengths():
+    with pytest.raises(ValueError):
+        onehot_sequences(["ACGT", "ACG"])